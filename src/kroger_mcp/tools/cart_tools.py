@@ -2,14 +2,15 @@
 Cart tracking and management functionality
 """
 import json
+import logging
 import os
-import sys
 from datetime import datetime
 from typing import Dict, Any, List
 
 from fastmcp import Context
 from .shared import get_authenticated_client, resolve_data_file
 
+logger = logging.getLogger(__name__)
 
 # Cart storage file (resolved to the shared per-user data directory)
 CART_FILE = "kroger_cart.json"
@@ -34,7 +35,7 @@ def _save_cart_data(cart_data: Dict[str, Any]) -> None:
         with open(resolve_data_file(CART_FILE), 'w') as f:
             json.dump(cart_data, f, indent=2)
     except Exception as e:
-        print(f"Warning: Could not save cart data: {e}", file=sys.stderr)
+        logger.warning("Could not save cart data: %s", e)
 
 
 def _load_order_history() -> List[Dict[str, Any]]:
@@ -55,7 +56,7 @@ def _save_order_history(history: List[Dict[str, Any]]) -> None:
         with open(resolve_data_file(ORDER_HISTORY_FILE), 'w') as f:
             json.dump(history, f, indent=2)
     except Exception as e:
-        print(f"Warning: Could not save order history: {e}", file=sys.stderr)
+        logger.warning("Could not save order history: %s", e)
 
 
 def _add_item_to_local_cart(product_id: str, quantity: int, modality: str, product_details: Dict[str, Any] = None) -> None:
@@ -2,56 +2,128 @@
 Shared utilities and client management for Kroger MCP server
 """
 
+import functools
+import logging
 import os
-import sys
-import json
-from typing import Optional, Dict, Any
+import threading
+import time
+from typing import Optional, Dict, Any, Tuple
 from dotenv import load_dotenv
 
 from kroger_api.kroger_api import KrogerAPI
 from kroger_api.utils.env import load_and_validate_env, get_zip_code
 from kroger_api.token_storage import load_token, get_token_file_path
 
+# orjson is optional; fall back to the stdlib encoder when it isn't installed
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    import json
+
+    _loads = json.loads
+
+    def _dumps(obj: Any) -> bytes:
+        # ensure_ascii (the default) yields pure ASCII, so encoding is a plain copy
+        return json.dumps(obj, indent=2).encode("ascii")
+
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 
 # Global state for clients and preferred location
 _authenticated_client: Optional[KrogerAPI] = None
+_auth_client_valid_until: float = 0.0
 _client_credentials_client: Optional[KrogerAPI] = None
+_cc_lock = threading.Lock()
+_auth_lock = threading.Lock()
+
+# Stop trusting a cached token this many seconds before it expires
+_TOKEN_EXPIRY_MARGIN = 30
 
 # JSON files for configuration storage
 PREFERENCES_FILE = "kroger_preferences.json"
 
+# Set KROGER_MCP_FSYNC_PREFS=1 to fsync the preferences file before it is
+# swapped into place; off by default since losing it on a crash is harmless
+_FSYNC_PREFS = os.getenv("KROGER_MCP_FSYNC_PREFS") == "1"
+
+# Last preferences read from or written to disk, keyed on the file's mtime
+_prefs_cache: Optional[dict] = None
+_prefs_mtime: int = 0
+
+
+@functools.lru_cache(maxsize=None)
+def _validate_env(required_vars: Tuple[str, ...]) -> None:
+    """Validate required environment variables, remembering each set that passed"""
+    # .env was loaded at import; only fall back to kroger_api (which reloads
+    # it and builds the error message) when something is missing or blank
+    if all(os.environ.get(var, "").strip() for var in required_vars):
+        return
+    load_and_validate_env(list(required_vars))
+
 
 def get_client_credentials_client() -> KrogerAPI:
     """Get or create a client credentials authenticated client for public data"""
     global _client_credentials_client
     
-    if _client_credentials_client is not None and _client_credentials_client.test_current_token():
-        return _client_credentials_client
-    
-    _client_credentials_client = None
+    client = _client_credentials_client
+    if client is not None and client.test_current_token():
+        return client
     
-    try:
-        load_and_validate_env(["KROGER_CLIENT_ID", "KROGER_CLIENT_SECRET"])
-        _client_credentials_client = KrogerAPI()
-        
-        # Try to load existing token first
-        token_file = ".kroger_token_client_product.compact.json"
-        token_info = load_token(token_file)
+    with _cc_lock:
+        # Another call may have minted a fresh client while we waited for the lock
+        if _client_credentials_client is not None and _client_credentials_client is not client:
+            return _client_credentials_client
         
-        if token_info:
-            # Test if the token is still valid
-            _client_credentials_client.client.token_info = token_info
-            if _client_credentials_client.test_current_token():
-                # Token is valid, use it
-                return _client_credentials_client
+        _client_credentials_client = None
         
-        # Token is invalid or not found, get a new one
-        token_info = _client_credentials_client.authorization.get_token_with_client_credentials("product.compact")
-        return _client_credentials_client
-    except Exception as e:
-        raise Exception(f"Failed to get client credentials: {str(e)}")
+        try:
+            _validate_env(("KROGER_CLIENT_ID", "KROGER_CLIENT_SECRET"))
+            client = KrogerAPI()
+            
+            # Try to load existing token first
+            token_file = ".kroger_token_client_product.compact.json"
+            token_info = load_token(token_file)
+            
+            if token_info:
+                # Test if the token is still valid
+                client.client.token_info = token_info
+                if client.test_current_token():
+                    # Token is valid, use it
+                    _client_credentials_client = client
+                    return client
+            
+            # Token is invalid or not found, get a new one
+            client.authorization.get_token_with_client_credentials("product.compact")
+            _client_credentials_client = client
+            return client
+        except Exception as e:
+            raise Exception(f"Failed to get client credentials: {str(e)}")
+
+
+def _token_deadline(token_info: Dict[str, Any], token_file: str) -> float:
+    """Monotonic time shortly before a saved token expires
+
+    kroger_api writes the token file whenever a token is issued or refreshed,
+    so its mtime is taken as the issue time for the relative expires_in.
+    """
+    try:
+        issued_at = os.path.getmtime(get_token_file_path(token_file))
+    except OSError:
+        return 0.0
+    remaining = issued_at + token_info.get("expires_in", 0) - time.time()
+    return time.monotonic() + remaining - _TOKEN_EXPIRY_MARGIN
+
+
+def _token_locally_valid(token_info: Optional[Dict[str, Any]], token_file: str) -> bool:
+    """Check a saved token's expiry against the local clock, without a network call"""
+    return bool(token_info) and time.monotonic() < _token_deadline(token_info, token_file)
 
 
 def get_authenticated_client() -> KrogerAPI:
@@ -67,61 +139,82 @@ def get_authenticated_client() -> KrogerAPI:
     Raises:
         Exception: If no valid token is available and authentication is required
     """
-    global _authenticated_client
-    
-    if _authenticated_client is not None and _authenticated_client.test_current_token():
-        # Client exists and token is still valid
-        return _authenticated_client
+    global _authenticated_client, _auth_client_valid_until
     
-    # Clear the reference if token is invalid
-    _authenticated_client = None
+    # Skip the network probe while the cached token has time left on it
+    client = _authenticated_client
+    if client is not None and time.monotonic() < _auth_client_valid_until:
+        return client
     
-    try:
-        load_and_validate_env(["KROGER_CLIENT_ID", "KROGER_CLIENT_SECRET", "KROGER_REDIRECT_URI"])
+    # test_current_token() may refresh and swap the client's token_info, so
+    # the check runs under the lock along with (re)creating the client
+    with _auth_lock:
+        client = _authenticated_client
+        if client is not None:
+            token_file = client.client.token_file
+            # The client may have refreshed its token on a 401 since we last
+            # looked; only probe when the local expiry check can't vouch for it
+            if _token_locally_valid(client.client.token_info, token_file) or client.test_current_token():
+                # Client exists and token is still valid
+                _auth_client_valid_until = _token_deadline(client.client.token_info, token_file)
+                return client
         
-        # Try to load existing user token first
-        token_file = ".kroger_token_user.json"
-        token_info = load_token(token_file)
+        # Clear the reference if token is invalid
+        _authenticated_client = None
+        _auth_client_valid_until = 0.0
         
-        if token_info:
-            # Create a new client with the loaded token
-            _authenticated_client = KrogerAPI()
-            _authenticated_client.client.token_info = token_info
-            _authenticated_client.client.token_file = token_file
+        try:
+            _validate_env(("KROGER_CLIENT_ID", "KROGER_CLIENT_SECRET", "KROGER_REDIRECT_URI"))
             
-            if _authenticated_client.test_current_token():
-                # Token is valid, use it
-                return _authenticated_client
+            # Try to load existing user token first
+            token_file = ".kroger_token_user.json"
+            token_info = load_token(token_file)
             
-            # Token is invalid, try to refresh it
-            if "refresh_token" in token_info:
-                try:
-                    _authenticated_client.authorization.refresh_token(token_info["refresh_token"])
-                    # If refresh was successful, return the client
-                    if _authenticated_client.test_current_token():
-                        return _authenticated_client
-                except Exception:
-                    # Refresh failed, need to re-authenticate
-                    _authenticated_client = None
-        
-        # No valid token available, need user-initiated authentication
-        raise Exception(
-            "Authentication required. Please use the start_authentication tool to begin the OAuth flow, "
-            "then complete it with the complete_authentication tool."
-        )
-    except Exception as e:
-        if "Authentication required" in str(e):
-            # This is an expected error when authentication is needed
-            raise
-        else:
-            # Other unexpected errors
-            raise Exception(f"Authentication failed: {str(e)}")
+            if token_info:
+                # Create a new client with the loaded token
+                client = KrogerAPI()
+                client.client.token_info = token_info
+                client.client.token_file = token_file
+                
+                if _token_locally_valid(token_info, token_file):
+                    valid = True
+                elif "refresh_token" in token_info:
+                    # Expired by the local clock, so refresh straight away
+                    # rather than probing first
+                    try:
+                        client.authorization.refresh_token(token_info["refresh_token"])
+                        valid = True
+                    except Exception:
+                        # Refresh failed, need to re-authenticate
+                        valid = False
+                else:
+                    # Nothing to refresh with; let the API decide
+                    valid = client.test_current_token()
+                
+                if valid:
+                    _authenticated_client = client
+                    _auth_client_valid_until = _token_deadline(client.client.token_info, token_file)
+                    return client
+            
+            # No valid token available, need user-initiated authentication
+            raise Exception(
+                "Authentication required. Please use the start_authentication tool to begin the OAuth flow, "
+                "then complete it with the complete_authentication tool."
+            )
+        except Exception as e:
+            if "Authentication required" in str(e):
+                # This is an expected error when authentication is needed
+                raise
+            else:
+                # Other unexpected errors
+                raise Exception(f"Authentication failed: {str(e)}")
 
 
 def invalidate_authenticated_client():
     """Invalidate the authenticated client to force re-authentication"""
-    global _authenticated_client
+    global _authenticated_client, _auth_client_valid_until
     _authenticated_client = None
+    _auth_client_valid_until = 0.0
 
 
 def invalidate_client_credentials_client():
@@ -146,40 +239,94 @@ def resolve_data_file(filename: str) -> str:
             with open(filename, 'r') as src, open(path, 'w') as dst:
                 dst.write(src.read())
         except Exception as e:
-            print(f"Warning: Could not migrate {filename} from CWD: {e}", file=sys.stderr)
+            logger.warning("Could not migrate %s from CWD: %s", filename, e)
     return path
 
 
-def _load_preferences() -> dict:
-    """Load preferences from file"""
+@functools.lru_cache(maxsize=1)
+def _preferences_path() -> str:
+    """Resolve (and create the directory for) the preferences file once per process"""
+    return resolve_data_file(PREFERENCES_FILE)
+
+
+def _load_preferences(copy: bool = True) -> dict:
+    """Load preferences from file, reusing the cached copy while it is unchanged
+
+    Pass copy=False for read-only lookups to get the cached dict itself
+    instead of a copy; callers must not mutate it.
+    """
+    global _prefs_cache, _prefs_mtime
     try:
-        prefs_path = resolve_data_file(PREFERENCES_FILE)
-        if os.path.exists(prefs_path):
-            with open(prefs_path, 'r') as f:
-                return json.load(f)
+        prefs_path = _preferences_path()
+        try:
+            mtime = os.stat(prefs_path).st_mtime_ns
+        except FileNotFoundError:
+            return {"preferred_location_id": None}
+        if _prefs_cache is not None and mtime == _prefs_mtime:
+            return _prefs_cache.copy() if copy else _prefs_cache
+        # Unbuffered read; take the mtime from the open file so the cache is
+        # keyed on the version actually read, even if it changed since the stat
+        with open(prefs_path, 'rb', buffering=0) as f:
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+            preferences = _loads(f.readall())
+        _prefs_cache, _prefs_mtime = preferences, mtime
+        return preferences.copy() if copy else preferences
     except Exception as e:
-        print(f"Warning: Could not load preferences: {e}", file=sys.stderr)
+        logger.warning("Could not load preferences: %s", e)
     return {"preferred_location_id": None}
 
 
+def _atomic_write_bytes(path: str, data: bytes, fsync: bool = False) -> None:
+    """Write bytes to a sibling temp file with raw os calls, then swap it into place"""
+    temp_file = path + ".tmp"
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    try:
+        fd = os.open(temp_file, flags, 0o600)
+    except FileNotFoundError:
+        # The data directory is only ensured once per process; recreate
+        # it if it was removed while the server was running
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(temp_file, flags, 0o600)
+    try:
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            if fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temp_file, path)
+    except Exception:
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+        raise
+
+
 def _save_preferences(preferences: dict) -> None:
     """Save preferences to file"""
+    global _prefs_cache, _prefs_mtime
     try:
-        with open(resolve_data_file(PREFERENCES_FILE), 'w') as f:
-            json.dump(preferences, f, indent=2)
+        prefs_path = _preferences_path()
+        _atomic_write_bytes(prefs_path, _dumps(preferences), fsync=_FSYNC_PREFS)
+        _prefs_cache, _prefs_mtime = preferences.copy(), os.stat(prefs_path).st_mtime_ns
     except Exception as e:
-        print(f"Warning: Could not save preferences: {e}", file=sys.stderr)
+        logger.warning("Could not save preferences: %s", e)
 
 
 def get_preferred_location_id() -> Optional[str]:
     """Get the current preferred location ID from preferences file"""
-    preferences = _load_preferences()
+    preferences = _load_preferences(copy=False)
     return preferences.get("preferred_location_id")
 
 
 def set_preferred_location_id(location_id: str) -> None:
     """Set the preferred location ID in preferences file"""
     preferences = _load_preferences()
+    if preferences.get("preferred_location_id") == location_id:
+        return
     preferences["preferred_location_id"] = location_id
     _save_preferences(preferences)
 
@@ -191,6 +338,7 @@ def format_currency(value: Optional[float]) -> str:
     return f"${value:.2f}"
 
 
+@functools.lru_cache(maxsize=1)
 def get_default_zip_code() -> str:
     """Get the default zip code from environment or fallback"""
     return get_zip_code(default="10001")